@@ -1,26 +1,71 @@
 import streamlit as st
 import requests
 import re
-from PIL import Image
 import io
 import datetime
 import pandas as pd
-import uuid
-import os
 import base64
-import dotenv
-from mistralai import Mistral
-import json
+import hashlib
+try:
+    import orjson as fast_json
+except ImportError:  # orjson is optional
+    import json as fast_json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from mistral_common import (
+    MISTRAL_API_URL, MISTRAL_TIMEOUT, MEAL_PLAN_CACHE_TTL, MealPlanError,
+    get_mistral_api_key, get_http_session, iter_sse_deltas, get_fresh_entry, store_entry,
+)
 
-dotenv.load_dotenv()
 # === Configuration for APIs ===
 # Store API keys in environment variables or Streamlit secrets
-api_key = os.environ.get("MISTRAL_API_KEY")
-MISTRAL_API_URL = "https://api.mistral.ai/v1/chat/completions"
+# Profile fields, in the order they appear in a meal plan cache key
+PROFILE_FIELDS = (
+    "age", "gender", "weight", "height", "activity", "dietary",
+    "menstrual_cycle", "fitness_goal", "additional_preferences",
+)
+ANALYSIS_TIMEOUT = 120  # seconds to wait for a background food analysis
+ANALYSIS_CACHE_MAX_ENTRIES = 32  # analyzed photos kept for replay
+ANALYSIS_CACHE_TTL = 3600  # seconds an analysis is replayed for the same photo
+MEAL_PLAN_WAIT_TIMEOUT = 300  # seconds an identical request waits for the one in flight
+MISTRAL_TIMEOUT_MS = 60000  # per-request timeout for the Mistral SDK client
+MAX_IMAGE_SIDE = 1024  # pixels; the vision model gains nothing from larger photos
+NUTRIENT_UNITS = {"calories": "kcal"}  # every other nutrient is reported in grams
+
+# === Precompiled Patterns ===
+# Marker the prompt asks the model to put after each day's plan
+DAY_END_MARKER = "-=*=-"
+# Day headers look like "DAY X: DAY_NAME"
+DAY_HEADER_RE = re.compile(r"DAY\s+\d+[\s:.-]*([A-Za-z]+)", re.IGNORECASE)
 
-def get_mistral_api_key():
-    """Helper function to get the Mistral API key."""
-    return os.environ.get("MISTRAL_API_KEY")
+# Opening of a fenced JSON block in the vision model's reply
+JSON_FENCE = "```json"
+
+# Static instruction for the vision model; it is sent before the image so the prompt prefix stays identical
+NUTRITION_PROMPT = """What's in this image? Please provide a full nutritional breakdown of this meal in JSON format. Output JSON without any additional text. This is what the JSON output should look like. The Numbers should be operable float numbers 
+{
+    "meal": "Meal name",
+    "ingredients": {
+        "ingredient1": {
+            "calories": 300,
+            "carbohydrates": 50,
+            "protein": 5,
+            "fat": 5
+        },
+        "ingredient2": {
+            "calories": 150,
+            "carbohydrates": 20,
+            "protein": 10,
+            "fat": 5
+        }
+    },
+    "total": {
+        "calories": 450,
+        "carbohydrates": 70,
+        "protein": 15, 
+        "fat": 10
+    }
+}"""
 
 # === Collapsible Meal Plan Display (New) ===
 def display_collapsible_meal_plan(day_content):
@@ -42,11 +87,25 @@ def display_collapsible_meal_plan(day_content):
         st.markdown(day_content)
 
 # === API Call Functions ===
-def generate_meal_plan(profile):
-    """Generate a personalized meal plan using Mistral AI API with additional user preferences."""
+def profile_cache_key(profile):
+    """Canonical, hashable form of a profile; the order of dietary choices does not matter."""
+    return tuple(
+        tuple(sorted(profile[field])) if field == "dietary" else profile.get(field)
+        for field in PROFILE_FIELDS
+    )
+
+@st.cache_resource
+def get_meal_plan_store():
+    """Completed meal plans shared across sessions: profile key -> (timestamp, text)."""
+    return {}
+
+def stream_meal_plan(profile_key):
+    """
+    Stream a meal plan from the Mistral AI API for a profile cache key.
+    Yields content deltas from the server-sent events as they arrive.
+    """
+    profile = dict(zip(PROFILE_FIELDS, profile_key))
     api_key = get_mistral_api_key()
-    if not api_key:
-        return "Error: Mistral API key not found. Please set up your API key."
     
     # Build prompt based on profile and additional preferences
     prompt = (
@@ -78,43 +137,104 @@ def generate_meal_plan(profile):
             {"role": "user", "content": prompt}
         ],
         "temperature": 0.7,
-        "max_tokens": 1500
+        "max_tokens": 1500,
+        "stream": True
     }
     
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+    # The key is sent per call so a rotated key takes effect without rebuilding the session
+    headers = {"Authorization": f"Bearer {api_key}"}
     
-    try:
-        response = requests.post(MISTRAL_API_URL, headers=headers, json=payload)
+    with get_http_session().post(MISTRAL_API_URL, headers=headers, json=payload, stream=True, timeout=MISTRAL_TIMEOUT) as response:
         response.raise_for_status()
-        
-        result = response.json()
-        meal_plan = result["choices"][0]["message"]["content"]
-        return meal_plan
+        yield from iter_sse_deltas(response)
+
+@st.cache_resource
+def get_inflight_requests():
+    """
+    Meal plan requests currently being fetched, shared by all sessions.
+    Returns a lock and a dict of profile key -> Future.
+    """
+    return threading.Lock(), {}
+
+def fetch_meal_plan_once(profile_key):
+    """
+    Yield the meal plan for a profile key, from the store when it is fresh.
+    Otherwise the first caller streams it from the API while identical requests
+    that arrive meanwhile wait for that single upstream call and get the full text.
+    """
+    store = get_meal_plan_store()
+    lock, inflight = get_inflight_requests()
+    with lock:
+        cached_plan = get_fresh_entry(store, profile_key, MEAL_PLAN_CACHE_TTL)
+        if cached_plan is not None:
+            future = None
+        else:
+            future = inflight.get(profile_key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                inflight[profile_key] = future
+    
+    if future is None:
+        yield cached_plan
+        return
+    if not is_owner:
+        try:
+            yield future.result(timeout=MEAL_PLAN_WAIT_TIMEOUT)
+        except FutureTimeoutError:
+            raise requests.exceptions.Timeout("Timed out waiting for an identical meal plan request.") from None
+        return
+    
+    chunks = []
+    try:
+        for chunk in stream_meal_plan(profile_key):
+            chunks.append(chunk)
+            yield chunk
+        meal_plan = "".join(chunks)
+        store_entry(store, profile_key, meal_plan, MEAL_PLAN_CACHE_TTL)
+        future.set_result(meal_plan)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    except BaseException:
+        # The owning script was stopped; release the waiters and let the stop propagate
+        future.set_exception(RuntimeError("Meal plan request was interrupted."))
+        raise
+    finally:
+        with lock:
+            inflight.pop(profile_key, None)
+
+def generate_meal_plan(profile):
+    """
+    Generate a personalized meal plan using Mistral AI API with additional user preferences.
+    Yields the plan text as it streams in; repeated requests for the same profile are
+    answered from the cache. Raises MealPlanError with a readable message on failure.
+    """
+    if not get_mistral_api_key():
+        raise MealPlanError("Error: Mistral API key not found. Please set up your API key.")
+    
+    try:
+        yield from fetch_meal_plan_once(profile_cache_key(profile))
     except requests.exceptions.RequestException as e:
-        return f"API Request Error: {str(e)}"
+        raise MealPlanError(f"API Request Error: {str(e)}") from e
     except KeyError as e:
-        return f"API Response Format Error: {str(e)}"
+        raise MealPlanError(f"API Response Format Error: {str(e)}") from e
     except Exception as e:
-        return f"Unexpected Error: {str(e)}"
+        raise MealPlanError(f"Unexpected Error: {str(e)}") from e
 
+@st.cache_data(max_entries=128, show_spinner=False)
 def parse_meal_plan_by_day(meal_plan_text):
     """
     Parse the meal plan text to extract daily meal plans using the marker "-=*=-" as an optional end delimiter.
     Returns a dictionary with day names as keys and the corresponding meal content as values.
     """
     daily_plans = {}
-    # This pattern will capture each day's section until it finds the marker "-=*=-" or the end of the text.
-    pattern = r"(?i)(DAY\s+\d+[\s:.-]*([A-Za-z]+))\s*(.*?)(?:\s*-=\*=-|$)"
-    
-    matches = re.finditer(pattern, meal_plan_text, re.DOTALL)
-    for match in matches:
-        header = match.group(1).strip()
-        day_name = match.group(2).capitalize()
-        day_content = match.group(3).strip()
-        daily_plans[day_name] = f"{header}\n{day_content}"
+    # Splitting on the marker first keeps this linear; no lazy DOTALL scan over the whole text
+    for chunk in meal_plan_text.split(DAY_END_MARKER):
+        match = DAY_HEADER_RE.search(chunk)
+        if match:
+            day_name = match.group(1).capitalize()
+            daily_plans[day_name] = chunk[match.start():].strip()
     
     if not daily_plans:
         daily_plans = {"Full Plan": meal_plan_text}
@@ -122,99 +242,142 @@ def parse_meal_plan_by_day(meal_plan_text):
     return daily_plans
 
 
-def encode_image_from_bytes(image_bytes):
-    """Encode the image bytes to base64."""
-    try:
-        return base64.b64encode(image_bytes).decode('utf-8')
-    except Exception as e:
-        print(f"Error encoding image: {e}")
-        return None
+def downscale_image(image_bytes):
+    """
+    Shrink the image to fit MAX_IMAGE_SIDE and re-encode it as JPEG (quality 85).
+    Phone photos drop from several MB to a few hundred KB before base64 and upload.
+    """
+    from PIL import Image, ImageOps  # imported lazily; only needed for food analysis
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=85, optimize=True)
+    return buffer.getvalue()
+
+def encode_image_data_url(image_bytes):
+    """Encode the image bytes straight into a base64 data URL, decoding to str once."""
+    return (b"data:image/jpeg;base64," + base64.b64encode(image_bytes)).decode('ascii')
+
+@st.cache_resource
+def get_mistral_client(api_key):
+    """
+    Create the Mistral client once per API key so its HTTP connection pool is reused
+    across analyses; a rotated key gets a fresh client.
+    """
+    from mistralai import Mistral  # imported lazily; only needed for food analysis
+    return Mistral(api_key=api_key, timeout_ms=MISTRAL_TIMEOUT_MS)
 
-def recognize_food(image_bytes):
-    """Recognize food in an image using Mistral's multimodal API."""
+def request_nutritional_breakdown(client, image_bytes):
+    """Ask Mistral's multimodal API for a JSON nutritional breakdown of the image."""
+    image_url = encode_image_data_url(downscale_image(image_bytes))
+    
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": NUTRITION_PROMPT
+                },
+                {
+                    "type": "image_url",
+                    "image_url": image_url
+                }
+            ]
+        }
+    ]
+    
+    chat_response = client.chat.complete(
+        model="pixtral-12b-2409",
+        messages=messages
+    )
+    return chat_response.choices[0].message.content
+
+@st.cache_resource
+def get_analysis_executor():
+    """Thread pool that analyzes uploaded images in the background, shared across sessions."""
+    return ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource
+def get_analysis_results():
+    """Completed analyses shared across sessions: image digest -> (timestamp, result)."""
+    return {}
+
+def analyze_food_image(client, image_bytes, digest, results):
+    """Worker-thread body of a food analysis; it makes no Streamlit calls."""
+    food_info = recognize_food(client, image_bytes)
+    store_entry(results, digest, food_info, ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_MAX_ENTRIES)
+    return food_info
+
+def start_food_analysis(image_bytes):
+    """
+    Start analyzing an image in the background and return its Future.
+    Cached resources are resolved here on the script thread, since the worker has no script context;
+    a photo analyzed recently is answered from the shared results without an API call.
+    """
+    digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    results = get_analysis_results()
+    cached_info = get_fresh_entry(results, digest, ANALYSIS_CACHE_TTL)
+    if cached_info is not None:
+        future = Future()
+        future.set_result(cached_info)
+        return future
+    client = get_mistral_client(get_mistral_api_key())
+    return get_analysis_executor().submit(analyze_food_image, client, image_bytes, digest, results)
+
+def extract_fenced_json(text):
+    """Return the body of the first ```json fenced block, or the text unchanged if there is none."""
+    start = text.find(JSON_FENCE)
+    if start == -1:
+        return text
+    start += len(JSON_FENCE)
+    end = text.find("```", start)
+    return text[start:end].strip() if end != -1 else text
+
+def extract_json(text):
+    """
+    Return the outermost {...} span of the text, dropping any prose around it.
+    A plain find/rfind scan; the text is returned unchanged if no object is found.
+    """
+    start = text.find('{')
+    end = text.rfind('}')
+    return text[start:end + 1] if 0 <= start < end else text
+
+def recognize_food(client, image_bytes):
+    """
+    Recognize food in an image using Mistral's multimodal API.
+    The readable analysis of parsed data is formatted later, on the script thread.
+    """
+    response_content = request_nutritional_breakdown(client, image_bytes)
+    
     try:
-        base64_image = encode_image_from_bytes(image_bytes)
-        if not base64_image:
-            return "Error: Failed to encode image."
-        
-        client = Mistral(api_key=api_key)
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": """What's in this image? Please provide a full nutritional breakdown of this meal in JSON format. Output JSON without any additional text. This is what the JSON output should look like. The Numbers should be operable float numbers 
-                        {
-                            "meal": "Meal name",
-                            "ingredients": {
-                                "ingredient1": {
-                                    "calories": 300,
-                                    "carbohydrates": 50,
-                                    "protein": 5,
-                                    "fat": 5
-                                },
-                                "ingredient2": {
-                                    "calories": 150,
-                                    "carbohydrates": 20,
-                                    "protein": 10,
-                                    "fat": 5
-                                }
-                            },
-                            "total": {
-                                "calories": 450,
-                                "carbohydrates": 70,
-                                "protein": 15, 
-                                "fat": 10
-                            }
-                        }"""
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": f"data:image/jpeg;base64,{base64_image}"
-                    }
-                ]
-            }
-        ]
+        json_content = response_content.strip()
+        if not json_content.startswith('{'):
+            json_content = extract_fenced_json(json_content)
         
-        chat_response = client.chat.complete(
-            model="pixtral-12b-2409",
-            messages=messages
-        )
-        response_content = chat_response.choices[0].message.content
+        nutritional_data = fast_json.loads(extract_json(json_content))
+        detected_items = list(nutritional_data.get('ingredients', {}).keys())
+        if not detected_items and 'meal' in nutritional_data:
+            detected_items = [nutritional_data['meal']]
         
-        try:
-            json_content = response_content
-            if not response_content.strip().startswith('{'):
-                json_match = re.search(r'```json\s*(.*?)\s*```', response_content, re.DOTALL)
-                if json_match:
-                    json_content = json_match.group(1)
-                else:
-                    json_match = re.search(r'(\{.*\})', response_content, re.DOTALL)
-                    if json_match:
-                        json_content = json_match.group(1)
-            
-            nutritional_data = json.loads(json_content)
-            detected_items = list(nutritional_data.get('ingredients', {}).keys())
-            if not detected_items and 'meal' in nutritional_data:
-                detected_items = [nutritional_data['meal']]
-            
-            nutritional_analysis = format_nutritional_data(nutritional_data)
-            
-            return {
-                "detected_items": detected_items,
-                "nutritional_analysis": nutritional_analysis,
-                "raw_data": nutritional_data
-            }
-        except json.JSONDecodeError:
-            return {
-                "detected_items": ["Unknown"],
-                "nutritional_analysis": "Could not parse nutritional data. Here's the raw response:\n\n" + response_content
-            }
-            
-    except Exception as e:
-        return f"Error recognizing food: {str(e)}"
+        return {
+            "detected_items": detected_items,
+            "raw_data": nutritional_data
+        }
+    except fast_json.JSONDecodeError:
+        return {
+            "detected_items": ["Unknown"],
+            "nutritional_analysis": "Could not parse nutritional data. Here's the raw response:\n\n" + response_content
+        }
+
+def format_nutrient_lines(nutrients):
+    """Yield one markdown bullet per nutrient, with its unit looked up in NUTRIENT_UNITS."""
+    return (
+        f"- {nutrient.title()}: {value} {NUTRIENT_UNITS.get(nutrient, 'g')}"
+        for nutrient, value in nutrients.items()
+    )
 
+@st.cache_data(max_entries=128, show_spinner=False)
 def format_nutritional_data(data):
     """Format the nutritional data from JSON to a readable format."""
     result = []
@@ -224,22 +387,30 @@ def format_nutritional_data(data):
         result.append("### Ingredients:")
         for ingredient, nutrients in data['ingredients'].items():
             result.append(f"#### {ingredient.title()}")
-            for nutrient, value in nutrients.items():
-                unit = "g" if nutrient != "calories" else "kcal"
-                result.append(f"- {nutrient.title()}: {value} {unit}")
+            result.extend(format_nutrient_lines(nutrients))
     if 'total' in data:
         result.append("### Total Nutritional Value:")
-        for nutrient, value in data['total'].items():
-            unit = "g" if nutrient != "calories" else "kcal"
-            result.append(f"- {nutrient.title()}: {value} {unit}")
+        result.extend(format_nutrient_lines(data['total']))
     return "\n".join(result)
 
-def save_meal_plan(profile, meal_plan):
-    """Save the generated meal plan to history."""
+def save_meal_plan(profile, meal_plan, daily_plans=None):
+    """
+    Save the generated meal plan to history.
+    Pass daily_plans when the plan has already been parsed to avoid parsing it again.
+    """
     if 'meal_plan_history' not in st.session_state:
         st.session_state.meal_plan_history = []
+    if 'meal_plan_index' not in st.session_state:
+        st.session_state.meal_plan_index = {}
+    if 'plan_seq' not in st.session_state:
+        st.session_state.plan_seq = 0
     
-    plan_id = str(uuid.uuid4())[:8]
+    if daily_plans is None:
+        daily_plans = parse_meal_plan_by_day(meal_plan)
+    
+    # A per-session counter is unique within the history and cheaper than a random UUID
+    st.session_state.plan_seq += 1
+    plan_id = f"P{st.session_state.plan_seq:04d}"
     profile_summary = f"{profile['gender']}, {profile['age']}yo, {profile['weight']}kg, {profile['height']}cm, {profile['fitness_goal']}"
     meal_plan_entry = {
         "id": plan_id,
@@ -247,20 +418,22 @@ def save_meal_plan(profile, meal_plan):
         "profile": profile_summary,
         "details": profile,
         "plan": meal_plan,
-        "daily_plans": parse_meal_plan_by_day(meal_plan)
+        "daily_plans": daily_plans
     }
     
     st.session_state.meal_plan_history.insert(0, meal_plan_entry)
+    st.session_state.meal_plan_index[plan_id] = meal_plan_entry
     return plan_id
 
 def load_meal_plan_from_history(plan_id):
     """Load a specific meal plan from history."""
-    if 'meal_plan_history' not in st.session_state:
+    if 'meal_plan_index' not in st.session_state:
         return None
-    for plan in st.session_state.meal_plan_history:
-        if plan["id"] == plan_id:
-            return plan
-    return None
+    return st.session_state.meal_plan_index.get(plan_id)
+
+def build_history_dataframe(history_rows):
+    """Build the history table from (id, date, profile) tuples."""
+    return pd.DataFrame(history_rows, columns=["ID", "Date", "Profile"])
 
 # === Streamlit UI ===
 def main():
@@ -274,10 +447,16 @@ def main():
         st.session_state.current_day = None
     if 'meal_plan_history' not in st.session_state:
         st.session_state.meal_plan_history = []
+    if 'meal_plan_index' not in st.session_state:
+        st.session_state.meal_plan_index = {}
     if 'current_plan_id' not in st.session_state:
         st.session_state.current_plan_id = None
     if 'history_current_day' not in st.session_state:
         st.session_state.history_current_day = None
+    if 'analysis_file_id' not in st.session_state:
+        st.session_state.analysis_file_id = None
+    if 'analysis_future' not in st.session_state:
+        st.session_state.analysis_future = None
     
     tab1, tab2 = st.tabs(["Meal Plan Generator", "Meal Plan History"])
     
@@ -319,19 +498,24 @@ def main():
             if not get_mistral_api_key():
                 st.error("Missing Mistral API key. Please configure it to generate meal plans.")
             else:
-                with st.spinner("Generating meal plan..."):
-                    meal_plan = generate_meal_plan(profile)
-                    if isinstance(meal_plan, str) and meal_plan.startswith("Error"):
-                        st.error(meal_plan)
-                    else:
-                        st.session_state.meal_plan = meal_plan
-                        daily_plans = parse_meal_plan_by_day(meal_plan)
-                        st.session_state.daily_plans = daily_plans
-                        if daily_plans:
-                            st.session_state.current_day = list(daily_plans.keys())[0]
-                        plan_id = save_meal_plan(profile, meal_plan)
-                        st.session_state.current_plan_id = plan_id
-                        st.success(f"Meal plan generated and saved to history (ID: {plan_id})!")
+                # Show the plan while it streams
+                stream_placeholder = st.empty()
+                try:
+                    with stream_placeholder.container():
+                        meal_plan = st.write_stream(generate_meal_plan(profile))
+                except MealPlanError as e:
+                    stream_placeholder.empty()
+                    st.error(str(e))
+                else:
+                    stream_placeholder.empty()
+                    st.session_state.meal_plan = meal_plan
+                    daily_plans = parse_meal_plan_by_day(meal_plan)
+                    st.session_state.daily_plans = daily_plans
+                    if daily_plans:
+                        st.session_state.current_day = list(daily_plans.keys())[0]
+                    plan_id = save_meal_plan(profile, meal_plan, daily_plans)
+                    st.session_state.current_plan_id = plan_id
+                    st.success(f"Meal plan generated and saved to history (ID: {plan_id})!")
         
         # --- Display the selected day in collapsible sections ---
         if st.session_state.meal_plan and st.session_state.current_day:
@@ -345,23 +529,41 @@ def main():
         st.header("Food Recognition & Logging")
         uploaded_file = st.file_uploader("Upload an image of your meal", type=["jpg", "jpeg", "png"])
         if uploaded_file is not None:
-            image = Image.open(uploaded_file)
-            st.image(image, caption="Uploaded Meal", use_column_width=True)
+            image_bytes = uploaded_file.getvalue()
+            st.image(image_bytes, caption="Uploaded Meal", use_column_width=True)
+            # Start the analysis as soon as a new image arrives so it overlaps with the user's next click
+            if get_mistral_api_key() and st.session_state.analysis_file_id != uploaded_file.file_id:
+                previous_future = st.session_state.analysis_future
+                if previous_future is not None:
+                    # The replaced photo's analysis is no longer needed; a running one still lands in the shared results
+                    previous_future.cancel()
+                st.session_state.analysis_file_id = uploaded_file.file_id
+                st.session_state.analysis_future = start_food_analysis(image_bytes)
             if st.button("Analyze Food"):
                 if not get_mistral_api_key():
                     st.error("Mistral API key is required for food analysis.")
                 else:
                     with st.spinner("Analyzing your food..."):
-                        img_byte_arr = io.BytesIO()
-                        image.save(img_byte_arr, format=image.format)
-                        img_byte_arr = img_byte_arr.getvalue()
-                        food_info = recognize_food(img_byte_arr)
+                        future = st.session_state.analysis_future
+                        if future is None or (future.done() and (future.cancelled() or future.exception() is not None)):
+                            # Nothing in flight, or the background attempt failed: analyze again now
+                            future = start_food_analysis(image_bytes)
+                            st.session_state.analysis_future = future
+                        try:
+                            food_info = future.result(timeout=ANALYSIS_TIMEOUT)
+                        except FutureTimeoutError:
+                            food_info = "Error recognizing food: the analysis timed out. Please try again."
+                        except Exception as e:
+                            food_info = f"Error recognizing food: {str(e)}"
                         st.markdown("### Food Analysis Results")
                         if isinstance(food_info, dict):
                             if "detected_items" in food_info:
                                 st.subheader("Detected Items")
                                 st.write(", ".join(food_info["detected_items"]))
-                            if "nutritional_analysis" in food_info:
+                            if "raw_data" in food_info:
+                                st.subheader("Nutritional Analysis")
+                                st.markdown(format_nutritional_data(food_info["raw_data"]))
+                            elif "nutritional_analysis" in food_info:
                                 st.subheader("Nutritional Analysis")
                                 st.markdown(food_info["nutritional_analysis"])
                             if "raw_data" in food_info:
@@ -375,36 +577,33 @@ def main():
         if not st.session_state.meal_plan_history:
             st.info("No meal plans have been generated yet. Generate a meal plan to see it here.")
         else:
-            history_data = []
-            for plan in st.session_state.meal_plan_history:
-                history_data.append({
-                    "ID": plan["id"],
-                    "Date": plan["date"],
-                    "Profile": plan["profile"],
-                })
-            history_df = pd.DataFrame(history_data)
+            history_df = build_history_dataframe(
+                tuple((plan["id"], plan["date"], plan["profile"]) for plan in st.session_state.meal_plan_history)
+            )
             st.dataframe(history_df, use_container_width=True)
+            # Build the labels once instead of scanning the history for every option
+            plan_labels = {plan["id"]: f'{plan["date"]} ({plan["profile"]})' for plan in st.session_state.meal_plan_history}
             selected_plan_id = st.selectbox(
                 "Select a meal plan to view:", 
                 options=[plan["id"] for plan in st.session_state.meal_plan_history],
-                format_func=lambda x: f"{x} - " + next((p["date"] + " (" + p["profile"] + ")" for p in st.session_state.meal_plan_history if p["id"] == x), "")
+                format_func=lambda x: f"{x} - {plan_labels[x]}"
             )
             if selected_plan_id:
                 selected_plan = load_meal_plan_from_history(selected_plan_id)
                 if selected_plan:
                     st.subheader(f"Meal Plan {selected_plan['id']} - {selected_plan['date']}")
                     with st.expander("View Profile Details"):
+                        # One markdown element instead of a column layout with a write per field
                         profile_details = selected_plan["details"]
-                        cols = st.columns(3)
-                        cols[0].write(f"**Age:** {profile_details['age']}")
-                        cols[0].write(f"**Gender:** {profile_details['gender']}")
-                        cols[1].write(f"**Weight:** {profile_details['weight']} kg")
-                        cols[1].write(f"**Height:** {profile_details['height']} cm")
-                        cols[2].write(f"**Activity:** {profile_details['activity']}")
-                        cols[2].write(f"**Goal:** {profile_details['fitness_goal']}")
-                        st.write(f"**Dietary Preferences:** {', '.join(profile_details['dietary'])}")
+                        details_lines = [
+                            f"**Age:** {profile_details['age']}  |  **Gender:** {profile_details['gender']}",
+                            f"**Weight:** {profile_details['weight']} kg  |  **Height:** {profile_details['height']} cm",
+                            f"**Activity:** {profile_details['activity']}  |  **Goal:** {profile_details['fitness_goal']}",
+                            f"**Dietary Preferences:** {', '.join(profile_details['dietary'])}",
+                        ]
                         if profile_details['gender'] == 'Female' and profile_details['menstrual_cycle'] != 'Not Applicable':
-                            st.write(f"**Menstrual Cycle Phase:** {profile_details['menstrual_cycle']}")
+                            details_lines.append(f"**Menstrual Cycle Phase:** {profile_details['menstrual_cycle']}")
+                        st.markdown("  \n".join(details_lines))
                     
                     st.subheader("Navigate Days")
                     days = list(selected_plan["daily_plans"].keys())
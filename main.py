@@ -1,82 +1,273 @@
 import streamlit as st
-import requests
+try:
+    import orjson as fast_json
+except ImportError:  # orjson is optional; the standard library parser works the same here
+    import json as fast_json
 import json
+import hashlib
+import tempfile
+from pathlib import Path
 import re
-import dotenv
 import os
-from PIL import Image
-import matplotlib.pyplot as plt
-
-dotenv.load_dotenv()
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from mistral_common import (
+    MISTRAL_API_URL, MISTRAL_TIMEOUT, MEAL_PLAN_CACHE_TTL, MealPlanError,
+    get_mistral_api_key, get_http_session, iter_sse_deltas, get_fresh_entry, store_entry,
+)
 
 # === Configuration for Mistral API ===
-MISTRAL_API_KEY = os.environ.get("MISTRAL_API_KEY")
-MISTRAL_API_URL = "https://api.mistral.ai/v1/chat/completions"
+MISTRAL_API_KEY = get_mistral_api_key()
+MEAL_PLAN_MODEL = os.environ.get("MEALPLAN_MODEL", "mistral-small-latest")
+MEAL_PLAN_SYSTEM_PROMPT = "You are a helpful nutrition expert. Create structured meal plans with clear sections."
+MEAL_PLAN_INSTRUCTIONS = (
+    "Generate one day of a personalized 7-day meal plan for the user profile below. Include:\n"
+    "- Breakfast, Lunch, Dinner, Snacks (no day header)\n"
+    "- Each day is planned separately, so avoid repeating the most common dishes; favour ones specific to this day\n"
+    "- Daily totals as 'Calories: N', 'Protein: N', 'Carbs: N', 'Fat: N', 'Fiber: N', plus key micronutrients\n"
+    "- One hydration tip"
+)
+# Static instructions go first so the provider can reuse its prompt cache; the profile goes last.
+# Both variants are built at import time, so rendering a prompt is a single % substitution.
+PROFILE_HEAD = (
+    "\n\nUser profile:\n"
+    "Age: %(age)s\n"
+    "Gender: %(gender)s\n"
+    "Weight: %(weight)skg\n"
+    "Height: %(height)scm\n"
+    "Activity level: %(activity)s\n"
+    "Dietary preferences: %(dietary)s\n"
+)
+MEAL_PLAN_PROMPT = MEAL_PLAN_INSTRUCTIONS + PROFILE_HEAD + "Fitness goal: %(fitness_goal)s"
+MEAL_PLAN_PROMPT_WITH_CYCLE = (
+    MEAL_PLAN_INSTRUCTIONS + PROFILE_HEAD
+    + "Menstrual cycle phase: %(menstrual_cycle)s\n"
+    + "Fitness goal: %(fitness_goal)s"
+)
+DAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+# Day requests in flight across all sessions (two full plans); the connection pool is sized to match
+MAX_CONCURRENT_DAY_REQUESTS = 2 * len(DAY_NAMES)
+# Completed plans are also kept on disk so they survive server restarts and redeploys
+MEAL_PLAN_CACHE_DIR = Path(os.environ.get("MEALPLAN_CACHE_DIR", "cache"))
+MEAL_PLAN_TMP_PREFIX = "mealplan-"  # marks this cache's own temporary files
+
+# === Precompiled Patterns ===
+EXPECTED_NUTRIENTS = ("Calories", "Protein", "Carbs", "Fat", "Fiber")
+# Day headers look like "DAY X: DAY_NAME" at the start of a line, possibly behind markdown
+# heading/bold/bullet markers; the capture group keeps them in re.split output
+DAY_SPLIT_RE = re.compile(r'^([ \t>#*_-]*DAY\s+\d+\s*:\s*[A-Z]+)', re.IGNORECASE | re.MULTILINE)
+# Nutrient lines look like "Protein: 30" (units are ignored); one pass finds all of them
+ALL_NUTRIENTS_RE = re.compile(
+    rf"(?P<nutrient>{'|'.join(EXPECTED_NUTRIENTS)})\s*:\s*(?P<value>[\d.]+)",
+    re.IGNORECASE,
+)
 
 # === API Call Functions ===
-def generate_meal_plan(profile):
+@st.cache_resource
+def get_day_request_slots():
     """
-    Generate a personalized meal plan using Mistral AI API.
+    Semaphore shared by all sessions that caps concurrent day requests at the pool size,
+    so simultaneous plans queue for a connection instead of opening and discarding extra ones.
+    """
+    return threading.BoundedSemaphore(MAX_CONCURRENT_DAY_REQUESTS)
+
+@st.cache_resource
+def get_meal_plan_store():
+    """Completed meal plans shared across sessions, keyed on the profile; streams can't use st.cache_data."""
+    return {}
+
+def profile_cache_key(profile):
+    """Build a hashable cache key from a profile dict."""
+    return tuple(sorted(
+        (field, tuple(value) if isinstance(value, list) else value)
+        for field, value in profile.items()
+    ))
+
+def disk_cache_path(profile):
+    """Path of the on-disk cache file for a profile, named by a hash of its canonical JSON."""
+    digest = hashlib.blake2b(json.dumps(profile, sort_keys=True).encode(), digest_size=16).hexdigest()
+    return MEAL_PLAN_CACHE_DIR / f"{digest}.json"
+
+def is_stale(path):
+    """Whether a cache file is older than the cache TTL."""
+    return time.time() - path.stat().st_mtime >= MEAL_PLAN_CACHE_TTL
+
+def is_cache_file(path):
+    """Whether path is one of this cache's entries or temporary files, not something else in the directory."""
+    if path.suffix == ".json":
+        stem = path.stem
+        return len(stem) == 32 and all(c in "0123456789abcdef" for c in stem)
+    return path.suffix == ".tmp" and path.name.startswith(MEAL_PLAN_TMP_PREFIX)
+
+def prune_disk_cache():
+    """Delete this cache's expired entries and leftover temporary files."""
+    for path in MEAL_PLAN_CACHE_DIR.iterdir():
+        if not is_cache_file(path):
+            continue
+        try:
+            if is_stale(path):
+                path.unlink()
+        except OSError:
+            pass  # already removed by another session
+
+def read_disk_plan(path):
+    """Return the plan stored at path if it exists and is still fresh, otherwise None."""
+    try:
+        if is_stale(path):
+            return None  # left for the sweep; another session may be rewriting it right now
+        return fast_json.loads(path.read_bytes())["plan"]
+    except (OSError, ValueError, KeyError):
+        return None  # a missing or unreadable entry is just a cache miss
+
+def write_disk_plan(path, meal_plan):
+    """Store a completed plan on disk; failing to write only costs a future cache hit."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Sessions are threads of one process, so each writer needs its own temporary file;
+        # the rename then publishes a complete entry
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, prefix=MEAL_PLAN_TMP_PREFIX, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as tmp:
+            json.dump({"plan": meal_plan}, tmp)
+        os.replace(tmp.name, path)
+        prune_disk_cache()
+    except OSError:
+        pass
+
+def build_meal_plan_prompt(profile):
+    """
+    Render the prompt shared by all seven day requests from the user profile.
+    Built once per plan; each day request only appends its day.
     """
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {MISTRAL_API_KEY}"
-    }
-    
-    # Build prompt based on profile, requesting structured days
-    prompt = (
-        f"Generate a personalized 7-day meal plan for a {profile['age']} year old {profile['gender']} "
-        f"with weight {profile['weight']}kg, height {profile['height']}cm, activity level {profile['activity']}, "
-        f"dietary preferences {', '.join(profile['dietary'])}, "
-    )
-    
     # Add menstrual cycle information only for females
     if profile['gender'] == "Female" and profile['menstrual_cycle'] != "Not Applicable":
-        prompt += f"menstrual cycle phase {profile['menstrual_cycle']}, "
+        template = MEAL_PLAN_PROMPT_WITH_CYCLE
+    else:
+        template = MEAL_PLAN_PROMPT
+    return template % dict(profile, dietary=", ".join(profile['dietary']))
+
+def stream_day_plan(session, plan_prompt, day_number, day_name):
+    """Stream one day of the meal plan from the Mistral AI API, yielding content deltas."""
+    headers = {"Authorization": f"Bearer {MISTRAL_API_KEY}"}
     
-    prompt += (
-        f"and a fitness goal of {profile['fitness_goal']}. "
-        "Include macronutrient and micronutrient breakdown, hydration tips, and balanced meals for the day. "
-        "Format each day clearly with 'DAY X: DAY_NAME' as a header (e.g., 'DAY 1: MONDAY'). "
-        "For each day include sections for Breakfast, Lunch, Dinner, and Snacks."
-    )
+    # The day goes last so every day request shares the same prompt prefix
+    prompt = f"{plan_prompt}\n\nPlan day {day_number} of 7 ({day_name})."
     
     payload = {
-        "model": "mistral-large-latest",
+        "model": MEAL_PLAN_MODEL,
         "messages": [
-            {"role": "system", "content": "You are a helpful nutrition expert. Create structured meal plans with clear day headers."},
+            {"role": "system", "content": MEAL_PLAN_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ],
         "temperature": 0.7,
-        "max_tokens": 1500  # Increased for a full week meal plan
+        "max_tokens": 400,  # Enough for one day in the terse format above
+        "stream": True
     }
     
-    try:
-        response = requests.post(MISTRAL_API_URL, headers=headers, json=payload)
+    with session.post(MISTRAL_API_URL, headers=headers, json=payload, stream=True, timeout=MISTRAL_TIMEOUT) as response:
         response.raise_for_status()
-        result = response.json()
-        meal_plan = result["choices"][0]["message"]["content"]
+        yield from iter_sse_deltas(response)
+
+def pump_day_plan(session, slots, plan_prompt, day_number, day_name, deltas, stop):
+    """
+    Stream one day of the meal plan into a queue from a worker thread, once a request slot is free.
+    Ends with None on success, or with the exception that stopped the stream.
+    Gives up and closes the response once stop is set.
+    """
+    while not slots.acquire(timeout=0.5):
+        if stop.is_set():
+            return
+    day_stream = stream_day_plan(session, plan_prompt, day_number, day_name)
+    try:
+        for delta in day_stream:
+            if stop.is_set():
+                return
+            deltas.put(delta)
+    except Exception as e:
+        deltas.put(e)
+    else:
+        deltas.put(None)
+    finally:
+        day_stream.close()  # exits the response context, releasing the connection
+        slots.release()
+
+def stream_meal_plan(profile):
+    """
+    Generate the seven days with concurrent streaming API calls, one per day.
+    Yields the days in week order: the current day live, later days from what was buffered meanwhile.
+    """
+    # Worker threads have no Streamlit script context, so resolve the cached resources here
+    session = get_http_session(MAX_CONCURRENT_DAY_REQUESTS)
+    slots = get_day_request_slots()
+    plan_prompt = build_meal_plan_prompt(profile)
+    day_queues = [queue.Queue() for _ in DAY_NAMES]
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=len(DAY_NAMES))
+    try:
+        for (day_number, day_name), deltas in zip(enumerate(DAY_NAMES, start=1), day_queues):
+            executor.submit(pump_day_plan, session, slots, plan_prompt, day_number, day_name, deltas, stop)
+        for (day_number, day_name), deltas in zip(enumerate(DAY_NAMES, start=1), day_queues):
+            # The header parse_meal_plan_by_day expects; the model is asked not to write its own
+            separator = "\n\n" if day_number > 1 else ""
+            yield f"{separator}DAY {day_number}: {day_name.upper()}\n"
+            while (delta := deltas.get()) is not None:
+                if isinstance(delta, Exception):
+                    raise delta
+                yield delta
+    finally:
+        # On an error or an abandoned stream, tell the workers to drop their streams and
+        # return right away instead of waiting for the remaining days to finish
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def generate_meal_plan(profile):
+    """
+    Generate a personalized meal plan using Mistral AI API.
+    Yields the plan text day by day; identical profiles are replayed from memory or disk.
+    Raises MealPlanError if the plan cannot be completed, so a partial plan is never kept.
+    """
+    key = profile_cache_key(profile)
+    cache = get_meal_plan_store()
+    meal_plan = get_fresh_entry(cache, key, MEAL_PLAN_CACHE_TTL)
+    if meal_plan is not None:
+        yield meal_plan
+        return
+    
+    disk_path = disk_cache_path(profile)
+    meal_plan = read_disk_plan(disk_path)
+    if meal_plan is not None:
+        store_entry(cache, key, meal_plan, MEAL_PLAN_CACHE_TTL)
+        yield meal_plan
+        return
+    
+    chunks = []
+    try:
+        for chunk in stream_meal_plan(profile):
+            chunks.append(chunk)
+            yield chunk
     except Exception as e:
-        meal_plan = f"Error generating meal plan: {e}"
+        raise MealPlanError(f"Error generating meal plan: {e}") from e
     
-    return meal_plan
+    # Only complete plans are cached, so failures are retried on the next click
+    meal_plan = "".join(chunks)
+    store_entry(cache, key, meal_plan, MEAL_PLAN_CACHE_TTL)
+    write_disk_plan(disk_path, meal_plan)
 
+@st.cache_data(max_entries=128, show_spinner=False)
 def parse_meal_plan_by_day(meal_plan_text):
     """
     Parse the meal plan text to extract daily meal plans.
     Returns a dictionary with days as keys and meal content as values.
     """
     daily_plans = {}
-    # Regular expression to find day headers (DAY X: DAY_NAME)
-    day_pattern = r'DAY\s+\d+\s*:\s*([A-Z]+)'
-    day_matches = list(re.finditer(day_pattern, meal_plan_text, re.IGNORECASE))
-    
-    for i, match in enumerate(day_matches):
-        day_name = match.group(1).capitalize()
-        start_pos = match.start()
-        end_pos = day_matches[i + 1].start() if i < len(day_matches) - 1 else len(meal_plan_text)
-        day_content = meal_plan_text[start_pos:end_pos].strip()
-        daily_plans[day_name] = day_content
+    # One split yields [preamble, header1, body1, header2, body2, ...]
+    parts = DAY_SPLIT_RE.split(meal_plan_text)
+    for header, body in zip(parts[1::2], parts[2::2]):
+        day_name = header.split(':', 1)[1].strip().capitalize()
+        daily_plans[day_name] = (header + body).strip()
 
     if not daily_plans:
         daily_plans = {"Full Plan": meal_plan_text}
@@ -89,38 +280,37 @@ def recognize_food(image_bytes):
     """
     return "Food recognition functionality using Mistral API is not available. Please use an alternative service."
 
+@st.cache_data(max_entries=1024, show_spinner=False)
+def extract_nutrients(day_plan_text):
+    """
+    Extract nutrient levels from the day's meal plan text.
+    Returns a dictionary of the expected nutrients found, in the expected order.
+    """
+    found = {}
+    for match in ALL_NUTRIENTS_RE.finditer(day_plan_text):
+        nutrient = match.group("nutrient").capitalize()
+        if nutrient in found:
+            continue  # keep the first mention of each nutrient
+        try:
+            found[nutrient] = float(match.group("value"))
+        except ValueError:
+            pass
+
+    # Keep the chart in the expected nutrient order
+    return {nutrient: found[nutrient] for nutrient in EXPECTED_NUTRIENTS if nutrient in found}
+
 def plot_nutrient_levels_for_day(day, day_plan_text):
     """
-    Extract nutrient levels from the day's meal plan text, plot a bar chart,
-    and if any key nutrient is missing, return a suggestions string.
+    Get the day's nutrient levels for charting, and if any key nutrient
+    is missing, return a suggestions string.
+    Uses the levels precomputed when the plan was generated, if available.
     
     Expected nutrients: Calories, Protein, Carbs, Fat, Fiber.
     """
-    expected_nutrients = ["Calories", "Protein", "Carbs", "Fat", "Fiber"]
-    nutrient_values = {}
-
-    # Look for patterns like "Protein: 30" in the text (units are ignored)
-    for nutrient in expected_nutrients:
-        pattern = rf"{nutrient}\s*:\s*([\d\.]+)"
-        match = re.search(pattern, day_plan_text, re.IGNORECASE)
-        if match:
-            try:
-                nutrient_values[nutrient] = float(match.group(1))
-            except ValueError:
-                pass
-
-    missing_nutrients = [nutrient for nutrient in expected_nutrients if nutrient not in nutrient_values]
-    
-    # Create bar chart
-    fig, ax = plt.subplots(figsize=(10, 5))
-    if nutrient_values:
-        ax.bar(nutrient_values.keys(), nutrient_values.values(), color='skyblue')
-        ax.set_title(f"Nutrient Levels for {day}")
-        ax.set_ylabel("Amount")
-        ax.set_xlabel("Nutrient")
-    else:
-        ax.text(0.5, 0.5, "No nutrient data found", horizontalalignment='center', verticalalignment='center')
-        ax.axis('off')
+    nutrient_values = st.session_state.get('nutrients_per_day', {}).get(day)
+    if nutrient_values is None:
+        nutrient_values = extract_nutrients(day_plan_text)
+    missing_nutrients = [nutrient for nutrient in EXPECTED_NUTRIENTS if nutrient not in nutrient_values]
     
     suggestion_text = ""
     if missing_nutrients:
@@ -135,7 +325,7 @@ def plot_nutrient_levels_for_day(day, day_plan_text):
         for nutrient in missing_nutrients:
             suggestion_text += f"- {nutrient}: {suggestions.get(nutrient, 'Consider a nutrient-rich snack.')}\n"
     
-    return fig, suggestion_text
+    return nutrient_values, suggestion_text
 
 # === Streamlit UI ===
 def main():
@@ -146,8 +336,8 @@ def main():
         st.session_state.meal_plan = None
     if 'daily_plans' not in st.session_state:
         st.session_state.daily_plans = {}
-    if 'current_day' not in st.session_state:
-        st.session_state.current_day = None
+    if 'nutrients_per_day' not in st.session_state:
+        st.session_state.nutrients_per_day = {}
     
     # User Profile Setup
     st.sidebar.header("User Profile Setup")
@@ -179,39 +369,47 @@ def main():
     # Meal Plan Generation Section
     st.header("Generate Your Meal Plan")
     if st.button("Generate 7-Day Meal Plan"):
-        with st.spinner("Generating meal plan..."):
-            meal_plan = generate_meal_plan(profile)
+        # Stream the plan live, then replace it with the day tabs below
+        stream_placeholder = st.empty()
+        try:
+            with stream_placeholder.container():
+                meal_plan = st.write_stream(generate_meal_plan(profile))
+        except MealPlanError as e:
+            stream_placeholder.empty()
+            st.error(str(e))
+        else:
+            stream_placeholder.empty()
             st.session_state.meal_plan = meal_plan
             
             # Parse the meal plan by day
             daily_plans = parse_meal_plan_by_day(meal_plan)
             st.session_state.daily_plans = daily_plans
             
-            # Set current day to the first day in the plan
-            if daily_plans:
-                st.session_state.current_day = list(daily_plans.keys())[0]
+            # Extract every day's nutrients now so switching days does no parsing
+            st.session_state.nutrients_per_day = {
+                day: extract_nutrients(day_text) for day, day_text in daily_plans.items()
+            }
     
-    # Display meal plan with day selection buttons
+    # Display the meal plan with one tab per day; tabs switch client-side without a rerun
     if st.session_state.meal_plan:
         st.subheader("Navigate Your Meal Plan")
-        cols = st.columns(len(st.session_state.daily_plans))
-        for i, day in enumerate(st.session_state.daily_plans.keys()):
-            if cols[i].button(day):
-                st.session_state.current_day = day
-        
-        if st.session_state.current_day:
-            st.markdown(f"### {st.session_state.current_day}'s Meal Plan")
-            st.markdown(st.session_state.daily_plans[st.session_state.current_day])
-            
-            # Plot nutrient levels for the selected day and show suggestions if needed
-            fig, suggestion_text = plot_nutrient_levels_for_day(
-                st.session_state.current_day,
-                st.session_state.daily_plans[st.session_state.current_day]
-            )
-            st.pyplot(fig)
-            if suggestion_text:
-                st.markdown("### Suggestions to Fill Nutrient Gaps")
-                st.write(suggestion_text)
+        daily_plans = st.session_state.daily_plans
+        day_tabs = st.tabs(list(daily_plans.keys()))
+        for day_tab, (day, day_text) in zip(day_tabs, daily_plans.items()):
+            with day_tab:
+                st.markdown(f"### {day}'s Meal Plan")
+                st.markdown(day_text)
+                
+                # Plot nutrient levels for the day and show suggestions if needed
+                nutrient_values, suggestion_text = plot_nutrient_levels_for_day(day, day_text)
+                if nutrient_values:
+                    st.markdown(f"#### Nutrient Levels for {day}")
+                    st.bar_chart(pd.Series(nutrient_values, name="Amount"))
+                else:
+                    st.info("No nutrient data found")
+                if suggestion_text:
+                    st.markdown("### Suggestions to Fill Nutrient Gaps")
+                    st.write(suggestion_text)
         
         with st.expander("View Complete Meal Plan"):
             st.markdown("### Your Complete 7-Day Meal Plan")
@@ -222,12 +420,13 @@ def main():
     uploaded_file = st.file_uploader("Upload an image of your meal", type=["jpg", "jpeg", "png"])
     
     if uploaded_file is not None:
-        image = Image.open(uploaded_file)
-        st.image(image, caption="Uploaded Meal", use_column_width=True)
+        # Preview the raw upload; no need to decode it
+        image_bytes = uploaded_file.getvalue()
+        st.image(image_bytes, caption="Uploaded Meal", use_column_width=True)
         
         if st.button("Recognize Food"):
             with st.spinner("Analyzing your food..."):
-                food_info = recognize_food(uploaded_file.getvalue())
+                food_info = recognize_food(image_bytes)
                 st.markdown("### Food Information")
                 st.write(food_info)
     
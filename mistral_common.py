@@ -0,0 +1,84 @@
+import streamlit as st
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson as fast_json
+except ImportError:  # orjson is optional; the standard library parser works the same here
+    import json as fast_json
+import dotenv
+import os
+import time
+
+# === Configuration for Mistral API ===
+MISTRAL_API_URL = "https://api.mistral.ai/v1/chat/completions"
+MISTRAL_TIMEOUT = (5, 60)  # (connect, read) seconds, so a stuck call cannot hang the worker
+MEAL_PLAN_CACHE_TTL = 3600  # seconds a generated plan is reused for an identical profile
+
+@st.cache_resource
+def load_env():
+    """Load the .env file once per process."""
+    dotenv.load_dotenv()
+
+def get_mistral_api_key():
+    """Read the Mistral API key on every call, so a key set or rotated later takes effect."""
+    load_env()
+    return os.environ.get("MISTRAL_API_KEY")
+
+class MealPlanError(Exception):
+    """Raised with a user-facing message when a meal plan cannot be generated."""
+
+# === API Call Functions ===
+@st.cache_resource
+def get_http_session(pool_maxsize=10):
+    """
+    Shared requests session for Mistral API calls, so every click reuses pooled
+    keep-alive connections instead of a fresh TCP + TLS handshake.
+    Rate limits and transient gateway errors are retried with backoff.
+    """
+    retries = Retry(
+        total=2,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["POST"],
+        raise_on_status=False,  # let raise_for_status report the final HTTP error
+    )
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json"})
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retries))
+    return session
+
+def iter_sse_deltas(response):
+    """Yield the content deltas of a streamed chat completion response."""
+    for line in response.iter_lines():
+        # Each event is a "data: {...}" line; the stream ends with "data: [DONE]"
+        if not line.startswith(b"data:"):
+            continue
+        data = line[len(b"data:"):].strip()
+        if data == b"[DONE]":
+            break
+        delta = fast_json.loads(data)["choices"][0]["delta"].get("content")
+        if delta:
+            yield delta
+
+# === Shared Result Stores ===
+def get_fresh_entry(store, key, ttl):
+    """Return the value stored under key if it is younger than ttl seconds, otherwise None."""
+    entry = store.get(key)
+    if entry and time.monotonic() - entry[0] < ttl:
+        return entry[1]
+    return None
+
+def store_entry(store, key, value, ttl, max_entries=None):
+    """
+    Store a value with its timestamp, dropping expired entries first and then the
+    oldest ones beyond max_entries, so a shared store cannot grow without bound.
+    """
+    now = time.monotonic()
+    # Iterate a copy; sessions run as concurrent threads
+    for stored_key, (stored_at, _) in list(store.items()):
+        if now - stored_at >= ttl:
+            store.pop(stored_key, None)
+    store[key] = (now, value)
+    while max_entries is not None and len(store) > max_entries:
+        store.pop(next(iter(store)), None)